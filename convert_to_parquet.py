@@ -0,0 +1,40 @@
+import argparse
+import io
+from google.cloud import storage
+import pandas as pd
+
+# Input files read by the ETL function in main.py
+FILE_PATHS = [
+    "customers.xlsx",
+    "products.xlsx",
+    "orders.xlsx",
+    "order_details.xlsx",
+]
+
+
+def convert_bucket(bucket_name):
+    """
+    One-off tool that converts the Excel input files in a bucket to Parquet siblings,
+    so the ETL function can skip Excel parsing in steady state.
+    """
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+
+    for file in FILE_PATHS:
+        data = bucket.blob(file).download_as_bytes()
+        df = pd.read_excel(io.BytesIO(data), engine="calamine")
+
+        buf = io.BytesIO()
+        df.to_parquet(buf, engine="pyarrow", index=False)
+        parquet_file = file.replace(".xlsx", ".parquet")
+        bucket.blob(parquet_file).upload_from_string(
+            buf.getvalue(), content_type="application/octet-stream"
+        )
+        print(f"Converted {file} to {parquet_file} in bucket {bucket_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Excel ETL inputs to Parquet.")
+    parser.add_argument("bucket", help="Name of the GCS bucket holding the input files")
+    args = parser.parse_args()
+    convert_bucket(args.bucket)
@@ -1,8 +1,155 @@
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
 from google.cloud import storage, bigquery
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import functions_framework
 
+# Clients are created once per container and reused across warm invocations
+STORAGE_CLIENT = storage.Client()
+BQ_CLIENT = bigquery.Client()
+
+# Columns read from each input file (None reads every column, as the dimension tables keep them all)
+SCHEMAS = {
+    "customers.xlsx": None,
+    "products.xlsx": None,
+    "orders.xlsx": ["OrderID", "CustomerID", "OrderDate", "ShipDate"],
+    "order_details.xlsx": ["OrderID", "ProductID", "Discount", "Quantity"],
+}
+
+# English weekday names, independent of the runtime locale (as dt.day_name() returned)
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Every date column is written as a UTC timestamp so BigQuery loads it as TIMESTAMP
+# (naive Arrow timestamps load as DATETIME)
+UTC_TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+# Explicit Order_Fact measure columns as (column, Arrow type, BigQuery type); the ID key
+# types are taken from the data in _order_fact_schemas
+ORDER_FACT_MEASURES = [
+    ("OrderDate", UTC_TIMESTAMP, "TIMESTAMP"),
+    ("ShipDate", UTC_TIMESTAMP, "TIMESTAMP"),
+    ("CustomerOrderCount", pa.int32(), "INTEGER"),
+    ("CustomerMeanDiscount", pa.float32(), "FLOAT"),
+    ("ProductOrderCount", pa.int32(), "INTEGER"),
+]
+
+
+def _key_type(name, dtype):
+    """
+    Map the pandas dtype of an ID column to its Arrow type, without inspecting the values.
+    """
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype):
+        # Nullable extension dtypes (Int64, Float64) expose their numpy equivalent
+        return pa.from_numpy_dtype(getattr(dtype, "numpy_dtype", dtype))
+    if pd.api.types.is_string_dtype(dtype):
+        return pa.string()
+    raise TypeError(f"Unsupported dtype {dtype} for ID column {name}.")
+
+
+def _bq_type(arrow_type):
+    """
+    Map an Arrow ID column type to the BigQuery type it loads as.
+    """
+    if pa.types.is_integer(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type):
+        return "FLOAT"
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return "STRING"
+    raise TypeError(f"Unsupported Arrow type {arrow_type} for an ID column.")
+
+
+def _order_fact_schemas(output_files):
+    """
+    Build the Arrow and BigQuery schemas for Order_Fact, with the ID key types taken from the
+    pandas dtypes so they match the (inferred) dimension tables.
+    """
+    key_columns = [
+        ("OrderID", output_files["Order_Fact"]["OrderID"].dtype),
+        ("CustomerID", output_files["Customer_Dimension"]["CustomerID"].dtype),
+        ("ProductID", output_files["Product_Dimension"]["ProductID"].dtype),
+    ]
+    key_types = [(name, _key_type(name, dtype)) for name, dtype in key_columns]
+    columns = [(name, arrow_type, _bq_type(arrow_type)) for name, arrow_type in key_types]
+    columns += ORDER_FACT_MEASURES
+    # ProductTotalQuantity is only an integer when the source quantities are
+    if pd.api.types.is_integer_dtype(output_files["Order_Fact"]["ProductTotalQuantity"]):
+        columns.append(("ProductTotalQuantity", pa.int32(), "INTEGER"))
+    else:
+        columns.append(("ProductTotalQuantity", pa.float32(), "FLOAT"))
+    return (
+        pa.schema([(name, arrow_type) for name, arrow_type, _ in columns]),
+        [bigquery.SchemaField(name, bq_type) for name, _, bq_type in columns],
+    )
+
+
+def _write_bq(output_files):
+    """
+    Load each output DataFrame into its own BigQuery table.
+    """
+    # Define your dataset ID (replace with your actual dataset)
+    dataset_id = "dark-caldron-441505-i4.data_mining"
+    print("Access")
+
+    # Only Order_Fact has an explicit schema; the other tables fall back to type inference
+    schemas = {"Order_Fact": _order_fact_schemas(output_files)}
+
+    # Serialize every table to Parquet before submitting any load job, so a conversion error
+    # fails the run without truncating some of the tables
+    buffers = {}
+    for table_name, df in output_files.items():
+        arrow_schema, _ = schemas.get(table_name, (None, None))
+
+        # Serialize to Parquet once ourselves instead of letting the client re-infer types
+        table = pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False)
+        # Inferred tables keep naive timestamps; mark them UTC to match Order_Fact
+        table = table.cast(
+            pa.schema(
+                [
+                    pa.field(field.name, UTC_TIMESTAMP) if pa.types.is_timestamp(field.type) else field
+                    for field in table.schema
+                ],
+                metadata=table.schema.metadata,
+            )
+        )
+        buf = io.BytesIO()
+        pq.write_table(
+            table, buf, compression="snappy", coerce_timestamps="us", allow_truncated_timestamps=True
+        )
+        buf.seek(0)
+        buffers[table_name] = buf
+
+    # Submit all BigQuery load jobs first so they run in parallel server-side
+    jobs = {}
+    for table_name, buf in buffers.items():
+        # Define full table ID
+        table_id = f"{dataset_id}.{table_name}"
+        _, bq_schema = schemas.get(table_name, (None, None))
+
+        # Each load job needs its own config
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,  # Overwrite table
+            source_format=bigquery.SourceFormat.PARQUET,  # Serialize via pyarrow, never CSV
+            schema=bq_schema,
+        )
+        parquet_options = bigquery.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config.parquet_options = parquet_options
+        jobs[table_name] = BQ_CLIENT.load_table_from_file(buf, table_id, job_config=job_config)
+
+    # Wait for all jobs to complete
+    for table_name, job in jobs.items():
+        job.result()
+        print(f"Table {table_name} written to BigQuery: {dataset_id}.{table_name}")
+
+
 # Triggered by a change in a storage bucket
 @functions_framework.cloud_event
 def hello_gcs(cloud_event):
@@ -17,25 +164,42 @@ def hello_gcs(cloud_event):
         print(f"Processing bucket: {bucket_name}")
 
         # File paths for input files
-        file_paths = [
-            "customers.xlsx",
-            "products.xlsx",
-            "orders.xlsx",
-            "order_details.xlsx",
-        ]
+        file_paths = list(SCHEMAS)
 
-        # Create a storage client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
+        bucket = STORAGE_CLIENT.bucket(bucket_name)
+
+        def download(file):
+            # Use the Parquet sibling (see convert_to_parquet.py) only if it is not older than the Excel file
+            excel_blob = blobs[file]
+            parquet_blob = blobs[file.replace(".xlsx", ".parquet")]
+            if parquet_blob is not None and (excel_blob is None or parquet_blob.updated >= excel_blob.updated):
+                blob = parquet_blob
+            elif excel_blob is not None:
+                blob = excel_blob
+            else:
+                raise FileNotFoundError(f"File {file} not found in bucket {bucket_name}.")
+            try:
+                return blob.name, blob.download_as_bytes()
+            except NotFound:
+                raise FileNotFoundError(f"File {file} not found in bucket {bucket_name}.")
+
+        # Every .xlsx/.parquet candidate name; get_blob returns None for missing objects
+        candidates = file_paths + [file.replace(".xlsx", ".parquet") for file in file_paths]
+
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            # Fetch the metadata of the candidates in parallel, independent of bucket size
+            blobs = dict(zip(candidates, executor.map(bucket.get_blob, candidates)))
+
+            # Download all input files in parallel
+            raw_bytes = dict(zip(file_paths, executor.map(download, file_paths)))
 
         # Read input files into DataFrames
         dataframes = {}
-        for file in file_paths:
-            blob = bucket.blob(file)
-            if not blob.exists():
-                raise FileNotFoundError(f"File {file} not found in bucket {bucket_name}.")
-            data = blob.download_as_string()
-            dataframes[file] = pd.read_excel(data, engine="openpyxl")
+        for file, (source, data) in raw_bytes.items():
+            if source.endswith(".parquet"):
+                dataframes[file] = pd.read_parquet(io.BytesIO(data), engine="pyarrow", columns=SCHEMAS[file])
+            else:
+                dataframes[file] = pd.read_excel(io.BytesIO(data), engine="calamine", usecols=SCHEMAS[file])
 
         # Extract individual DataFrames
         customers_df = dataframes["customers.xlsx"]
@@ -43,27 +207,34 @@ def hello_gcs(cloud_event):
         orders_df = dataframes["orders.xlsx"]
         order_details_df = dataframes["order_details.xlsx"]
 
-        # Transform: Join orders and order details
+        # Parse the date columns once, so text dates are handled and later steps can rely on datetimes
+        for col in ("OrderDate", "ShipDate"):
+            orders_df[col] = pd.to_datetime(orders_df[col])
+        customers_df["SignupDate"] = pd.to_datetime(customers_df["SignupDate"])
+
+        # Transform: Join orders and order details (both already limited to SCHEMAS columns)
         merged_df = orders_df.merge(order_details_df, on="OrderID", how="inner")
 
-        # Add aggregate attributes
-        customer_agg = (
-            merged_df.groupby("CustomerID")
-            .agg(CustomerOrderCount=("OrderID", "count"), CustomerMeanDiscount=("Discount", "mean"))
-            .reset_index()
-        )
-        product_agg = (
-            merged_df.groupby("ProductID")
-            .agg(ProductOrderCount=("OrderID", "count"), ProductTotalQuantity=("Quantity", "sum"))
-            .reset_index()
-        )
+        # Group on integer category codes rather than hashing the raw keys
+        for col in ("CustomerID", "ProductID"):
+            merged_df[col] = merged_df[col].astype("category")
+
+        # Add aggregate attributes (broadcast back onto each row without a join)
+        customer_groups = merged_df.groupby("CustomerID", sort=False, observed=True)
+        merged_df["CustomerOrderCount"] = customer_groups["OrderID"].transform("size")
+        merged_df["CustomerMeanDiscount"] = customer_groups["Discount"].transform("mean")
+        product_groups = merged_df.groupby("ProductID", sort=False, observed=True)
+        merged_df["ProductOrderCount"] = product_groups["OrderID"].transform("size")
+        merged_df["ProductTotalQuantity"] = product_groups["Quantity"].transform("sum")
 
-        # Merge aggregates
-        merged_with_aggregates = merged_df.merge(customer_agg, on="CustomerID", how="left")
-        merged_with_aggregates = merged_with_aggregates.merge(product_agg, on="ProductID", how="left")
+        # Quantity sums can only be downcast to an integer type if the quantities are integers
+        if pd.api.types.is_integer_dtype(order_details_df["Quantity"]):
+            quantity_dtype = "Int32"
+        else:
+            quantity_dtype = "float32"
 
         # Create Order Fact Table
-        order_fact_table = merged_with_aggregates[
+        order_fact_table = merged_df[
             [
                 "OrderID",
                 "CustomerID",
@@ -75,32 +246,46 @@ def hello_gcs(cloud_event):
                 "ProductOrderCount",
                 "ProductTotalQuantity",
             ]
-        ]
-
-        # Create Time Dimension Table
-        unique_dates = pd.concat([orders_df["OrderDate"], orders_df["ShipDate"]]).dropna().unique()
-        unique_dates = pd.to_datetime(unique_dates)
-        time_dim = pd.DataFrame({"Date": sorted(unique_dates)})
-        # Add additional columns
-        time_dim["TimeID"] = time_dim["Date"].dt.strftime("%Y%m%d")
-        time_dim["Year"] = time_dim["Date"].dt.year
-        time_dim["Month"] = time_dim["Date"].dt.month
-        time_dim["Day"] = time_dim["Date"].dt.day
-        time_dim["WeekDay"] = time_dim["Date"].dt.day_name()
-
-        order_fact_table["OrderDate"] = order_fact_table["OrderDate"].astype(str)
-        order_fact_table["ShipDate"] = order_fact_table["ShipDate"].astype(str)
-        customers_df["SignupDate"] = customers_df["SignupDate"].astype(str)
-
-        # Convert all columns to string
-        time_dim = time_dim.astype(str)
-            
-        # Initialize BigQuery Client
-        bq_client = bigquery.Client()
-
-        # Define your dataset ID (replace with your actual dataset)
-        dataset_id = "dark-caldron-441505-i4.data_mining"
-        print("Access")
+        ].astype(
+            {
+                # Narrower types halve the Parquet payload sent to BigQuery; the nullable
+                # Int32 keeps the NaN aggregates of rows with a blank CustomerID/ProductID
+                "CustomerOrderCount": "Int32",
+                "CustomerMeanDiscount": "float32",
+                "ProductOrderCount": "Int32",
+                "ProductTotalQuantity": quantity_dtype,
+            }
+        )
+
+        # Create Time Dimension Table (in microseconds, the unit the dates are written in; nanoseconds
+        # would overflow dates outside 1677-2262 such as 9999-12-31 sentinels)
+        all_dates = np.concatenate(
+            [
+                orders_df["OrderDate"].to_numpy(dtype="datetime64[us]"),
+                orders_df["ShipDate"].to_numpy(dtype="datetime64[us]"),
+            ]
+        )
+        # np.unique sorts and de-duplicates in a single pass
+        dates = np.unique(all_dates[~np.isnat(all_dates)])
+        # Derive the calendar attributes from the day numbers in one pass each
+        days = dates.astype("datetime64[D]")
+        months = days.astype("datetime64[M]")
+        year = days.astype("datetime64[Y]").astype("int64") + 1970
+        month = months.astype("int64") % 12 + 1
+        day = (days - months).astype("int64") + 1
+        # 1970-01-01 was a Thursday, i.e. index 3 in WEEKDAY_NAMES
+        weekday = np.array(WEEKDAY_NAMES)[(days.view("int64") - 4) % 7]
+        time_dim = pd.DataFrame(
+            {
+                "Date": dates,
+                "TimeID": (year * 10000 + month * 100 + day).astype("int32"),
+                "Year": year.astype("int16"),
+                "Month": month.astype("int8"),
+                "Day": day.astype("int8"),
+                "WeekDay": weekday,
+            },
+            copy=False,
+        )
 
         # Define output DataFrames
         output_files = {
@@ -111,18 +296,7 @@ def hello_gcs(cloud_event):
         }
 
         # Write DataFrames to BigQuery
-        for table_name, df in output_files.items():
-            # Define full table ID
-            table_id = f"{dataset_id}.{table_name}"
-
-            # Write DataFrame to BigQuery
-            job_config = bigquery.LoadJobConfig(
-                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,  # Overwrite table
-            )
-            job = bq_client.load_table_from_dataframe(df, table_id, job_config=job_config)
-            job.result()  # Wait for the job to complete
-
-            print(f"Table {table_name} written to BigQuery: {table_id}")
+        _write_bq(output_files)
 
     except Exception as e:
         print(f"Error during ETL process: {e}")